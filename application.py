@@ -1,42 +1,119 @@
-import gc
+import hashlib
 import json
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from urllib.parse import parse_qs
-from io import BytesIO
 
+# Size the BLAS/OpenMP pools before torch (and its MKL/OpenMP runtimes)
+# load. The affinity mask respects operator pinning (taskset/cgroups), so
+# workers pinned to disjoint core sets size their pools to their own share
+# instead of nproc threads each; for unpinned processes this only makes
+# the default pool size explicit, with the env vars as operator overrides.
+_n_cores = len(os.sched_getaffinity(0))
+os.environ.setdefault("OMP_NUM_THREADS", str(_n_cores))
+os.environ.setdefault("MKL_NUM_THREADS", str(_n_cores))
+
+import numpy as np
 import torch
-import soundfile as sf
 
-from commons import intersperse
+try:
+    from orjson import dumps as _json_dumps  # returns bytes, SIMD escaping
+except ImportError:
+    def _json_dumps(obj): return json.dumps(obj).encode()
+
 from symbols import pad, waitau_symbols, hakka_symbols, waitau_symbol_to_id, hakka_symbol_to_id
-from utils import load_model
+from utils import load_model, share_identical_tensors
 
 class QueryError(Exception): pass
 class ToneError(Exception): pass
 class SymbolError(Exception): pass
 
+# Error bodies are pre-encoded so probe/scanner traffic never pays for a
+# JSON roundtrip; only the variable message part is serialized per error.
+_ERR_404 = (404, b'{"error": "Page not found"}')
+_ERR_DECODE = b'{"error": "Error while decoding URI: invalid characters", "message": '
+_ERR_OPTION = b'{"error": "Invalid option", "message": '
+_ERR_TONE = b'{"error": "Invalid syllable", "message": '
+_ERR_SYMBOL = b'{"error": "Unrecognized symbol", "message": '
+_ERR_UNEXPECTED = b'{"error": "Unexpected error", "message": '
+
+def _error(prefix, message):
+    return (500, prefix + _json_dumps(message) + b"}")
+
+# The same paths and query strings repeat heavily (fixed announcement
+# texts), so their parsed forms are memoized on the raw WSGI strings.
+# lru_cache does not cache raises, so invalid input still errors each time.
+@lru_cache(maxsize=1024)
+def _parse_path(path):
+    # The latin_1 round-trip recovers UTF-8 from the WSGI string; skip it
+    # on the (overwhelmingly common) all-ASCII fast path.
+    if not path.isascii(): path = path.encode("latin_1").decode()
+    return tuple(path.lower().strip("/").split("/"))
+
+@lru_cache(maxsize=1024)
+def _parse_query(query):
+    if not query.isascii(): query = query.encode("latin_1").decode()
+    return parse_qs(query.lower(),
+                    keep_blank_values=True, strict_parsing=True, errors="strict")
+
+_COMMON_HEADERS = [
+    ("Access-Control-Allow-Origin", "*"),
+    ("Cache-Control", "max-age=604800, public"),
+    ("Connection", "Keep-Alive"),
+    ("Keep-Alive", "timeout=120"),
+]
+
+class SynthesisCache:
+    """LRU cache of encoded audio responses keyed on the synthesis inputs."""
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(language, voice, speed, text):
+        return hashlib.md5(f"{language}|{voice}|{speed}|{text}".encode()).digest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+cache = SynthesisCache()
+
 def application(environ, start_response):
+    _warmup()
     code, content = app(environ.get("PATH_INFO"), environ.get("QUERY_STRING"))
-    if code == 200:
-        mime = "audio/mpeg"
+    headers = [("Content-Type", "audio/mpeg" if code == 200 else "application/json")] + _COMMON_HEADERS
+    if isinstance(content, bytes):
+        # Omitting Content-Length on streamed audio lets the server use
+        # chunked transfer and flush segments as they are synthesized.
+        headers.insert(1, ("Content-Length", str(len(content))))
+        start_response(str(code), headers)
+        yield content
     else:
-        mime = "application/json"
-        content = json.dumps(content).encode()
-    start_response(str(code), [
-        ("Content-Type", mime),
-        ("Content-Length", str(len(content))),
-        ("Access-Control-Allow-Origin", "*"),
-        ("Cache-Control", "max-age=604800, public"),
-        ("Connection", "Keep-Alive"),
-        ("Keep-Alive", "timeout=120"),
-    ])
-    yield content
+        start_response(str(code), headers)
+        yield from content
 
 def app(path, query):
     try:
-        function, language, text = path.encode("latin_1").decode().lower().strip("/").split("/")
+        function, language, text = _parse_path(path)
         if function != "tts" or language not in {"waitau", "hakka"}: raise ValueError("Invalid URI segment")
-        options = parse_qs(query.encode("latin_1").decode().lower(),
-                           keep_blank_values=True, strict_parsing=True, errors="strict")
+        options = _parse_query(query)
         voice = options.get("voice", ["male"])
         if len(voice) != 1: raise QueryError(f"Expected at most a single 'voice', received {len(voice)} values")
         voice = voice[0]
@@ -53,109 +130,265 @@ def app(path, query):
         codec, content, start, end, reason = err.args
         content = content[start:end]
         if isinstance(content, bytes): content = content.decode("latin_1")
-        return (500, {"error": "Error while decoding URI: invalid characters", "message": content})
+        return _error(_ERR_DECODE, content)
     except QueryError as err:
-        return (500, {"error": "Invalid option", "message": str(err)})
+        return _error(_ERR_OPTION, str(err))
     except ValueError:
-        return (404, {"error": "Page not found"})
+        return _ERR_404
     try:
-        buffer = BytesIO()
-        sf.write(buffer, generate_audio(language, voice, text.replace("+", " "), speed), 44100, format="WAV")
-        return (200, buffer.getvalue())
+        text = text.replace("+", " ")
+        key = SynthesisCache.key(language, voice, speed, text)
+        hit = cache.get(key)
+        if hit is not None: return (200, hit)
+        _check_text(language, text)
+        return (200, _stream_audio(language, voice, text, speed, key))
     except ToneError as err:
-        return (500, {"error": "Invalid syllable", "message": str(err)})
+        return _error(_ERR_TONE, str(err))
     except SymbolError as err:
-        return (500, {"error": "Unrecognized symbol", "message": str(err.__cause__)})
+        return _error(_ERR_SYMBOL, str(err.__cause__))
     except Exception as err:
-        return (500, {"error": "Unexpected error", "message": type(err).__name__ + ": " + str(err)})
+        return _error(_ERR_UNEXPECTED, type(err).__name__ + ": " + str(err))
 
 models = {}
 device = "cpu"
 
-def generate_audio(language, voice, text, speed):
-    global models
+torch.set_num_threads(_n_cores)
+torch.set_num_interop_threads(1)
 
-    name = f"{language}_{voice}"
-    if name not in models:
-        models[name] = load_model(f"data/{name}.pth", "data/config.json", len(waitau_symbols if language == "waitau" else hakka_symbols))
+class BatchingScheduler:
+    """Runs all inference on one thread, batching compatible requests.
+
+    Concurrent infer() calls on the same CPU compete for cores and run
+    slower in total than queueing them, so a single scheduler thread is the
+    only caller of infer() and gets all cores to itself. Requests queue for
+    up to max_wait; those for the same (model, speed) are padded to a
+    common length and share one forward pass, up to max_batch at a time.
+    Cache hits never reach the scheduler.
+    """
+
+    max_batch = 8
+    max_wait = 0.02
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = []
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, name, phones, tones, speed):
+        """Queue one utterance and block until its audio is ready."""
+        item = {"phones": phones, "tones": tones, "audio": None, "error": None, "done": threading.Event()}
+        with self.lock:
+            self.pending.append((name, speed, item))
+            self.wake.set()
+        item["done"].wait()
+        if item["error"] is not None: raise item["error"]
+        return item["audio"]
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.max_wait)
+            while True:
+                with self.lock:
+                    if not self.pending:
+                        self.wake.clear()
+                        break
+                    name, speed, _ = self.pending[0]
+                    batch = [entry for entry in self.pending if entry[0] == name and entry[1] == speed][:self.max_batch]
+                    for entry in batch:
+                        self.pending.remove(entry)
+                self._infer_batch(name, speed, [entry[2] for entry in batch])
+
+    def _infer_batch(self, name, speed, items):
+        try:
+            lengths = [item["phones"].size(0) for item in items]
+            max_len = max(lengths)
+            phones = torch.zeros(len(items), max_len, dtype=torch.long, device=device)
+            tones = torch.zeros(len(items), max_len, dtype=torch.long, device=device)
+            for i, item in enumerate(items):
+                phones[i, : lengths[i]] = item["phones"]
+                tones[i, : lengths[i]] = item["tones"]
+            lang_ids = torch.zeros_like(phones)
+            x_lengths = torch.as_tensor(lengths, dtype=torch.long, device=device)
+            with torch.no_grad():
+                audio, _, y_mask, _ = models[name].infer(
+                    phones,
+                    x_lengths,
+                    _speakers[: len(items)],
+                    tones,
+                    lang_ids,
+                    speed=speed,
+                )
+                # The decoder upsamples y_mask frames to samples; slice each
+                # item's audio to its own unpadded length.
+                upsample = audio.size(2) // y_mask.size(2)
+                for i, item in enumerate(items):
+                    item["audio"] = audio[i, 0, : int(y_mask[i].sum()) * upsample].cpu().numpy()
+        except Exception as err:
+            for item in items:
+                item["error"] = err
+        finally:
+            for item in items:
+                item["done"].set()
+
+_scheduler = BatchingScheduler()
+
+# Constant-shape speaker ids reused across batches instead of being
+# reallocated per call.
+_speakers = torch.zeros(BatchingScheduler.max_batch, dtype=torch.long, device=device)
+
+# Streamed responses are cut into up to this many segments of syllables,
+# each synthesized and flushed separately so playback can start early.
+# Segments never go below the minimum size: each one is synthesized as an
+# independent utterance with its own prosody, so short texts are kept
+# whole and only paragraph-length inputs pay the split at segment
+# boundaries in exchange for the earlier first byte.
+_STREAM_CHUNKS = 8
+_STREAM_MIN_SYLLABLES = 16
 
-    phones, tones, word2ph = [pad], [0], [1]
+# Mono PCM_16 WAV header with the RIFF/data sizes left at the streaming
+# sentinel 0xFFFFFFFF, since the total length is unknown up front.
+_WAV_HEADER = (
+    b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVEfmt "
+    + struct.pack("<IHHIIHH", 16, 1, 1, 44100, 44100 * 2, 2, 16)
+    + b"data" + struct.pack("<I", 0xFFFFFFFF)
+)
+
+def _pcm16(audio):
+    return np.clip(audio * 32767.0, -32768, 32767).astype("<i2").tobytes()
+
+def _check_text(language, text):
+    """Raise the same errors generate_audio would, before streaming starts.
+
+    The response status is fixed once the first chunk is yielded, so tone
+    and symbol errors must surface up front. The syllable cache makes this
+    pre-pass nearly free."""
     for syllable in text.split():
-        if len(syllable) == 1:
-            phones.append(syllable)
-            tones.append(0)
-            word2ph.append(1)
-            continue
+        key = (language, syllable)
+        if key not in _syllable_cache:
+            _syllable_cache[key] = _parse_syllable(language, syllable)
+
+def _stream_audio(language, voice, text, speed, key):
+    """Return an iterator of response chunks for the given text.
+
+    The first segment is synthesized eagerly, inside the caller's try
+    block and before any status line is sent, so model and inference
+    errors still produce a clean 500. The remaining segments stream
+    behind it; a failure there can no longer change the status, so the
+    stream ends (and the response stays uncached) instead of leaking a
+    traceback mid-response."""
+    syllables = text.split()
+    step = max(_STREAM_MIN_SYLLABLES, -(-len(syllables) // _STREAM_CHUNKS))
+    segments = [" ".join(syllables[start:start + step]) for start in range(0, len(syllables), step)]
+    first = _WAV_HEADER
+    if segments:
+        first += _pcm16(generate_audio(language, voice, segments[0], speed))
+    def stream():
+        parts = [first]
+        yield first
+        try:
+            for segment in segments[1:]:
+                chunk = _pcm16(generate_audio(language, voice, segment, speed))
+                parts.append(chunk)
+                yield chunk
+        except Exception:
+            return
+        cache.put(key, b"".join(parts))
+    return stream()
+
+_warmup_lock = threading.Lock()
+_warmed_up = bool(os.environ.get("TTS_API_SKIP_WARMUP"))
+
+def _warmup():
+    """Load every model and run a dummy inference on each so no real user
+    pays the cold-start cost of weight loading and first-kernel autotuning."""
+    global _warmed_up
+    if _warmed_up: return
+    with _warmup_lock:
+        if _warmed_up: return
+        for language in ("waitau", "hakka"):
+            for voice in ("male", "female"):
+                generate_audio(language, voice, "a1 a1", 1)
+        _warmed_up = True
+
+# The Cantonese/Hakka syllable inventories are closed and small, so parses
+# are memoized: after a few requests every syllable is a dict hit.
+_syllable_cache = {}
+
+# Marks every vowel as \x01 via str.translate, so vowel positions are found
+# with C-level find() instead of a per-character Python scan.
+_VOWEL_MAP = {ord(c): "\x01" for c in "aeiouäöüæ"}
+
+# pad is prepended to both symbol lists, so its id is 0 in both languages.
+_PAD_ID = waitau_symbol_to_id[pad]
+
+def _parse_syllable(language, syllable):
+    if len(syllable) == 1:
+        phones, tones, n_phones = (syllable,), (0,), 1
+    else:
         try:
             tone = int(syllable[-1], base=7)
         except ValueError as err:
             raise ToneError(f"'{syllable}' does not end with tone 0~6") from err
-        it = (i for i, c in enumerate(syllable) if c in "aeiouäöüæ")
-        index = next(it, 0)
+        vowels = syllable.translate(_VOWEL_MAP)
+        index = max(vowels.find("\x01"), 0)
         initial = syllable[:index]
         if language == "waitau":
-            final = syllable[index:-1]
-            phones += [initial, final]
-            tones += [tone, tone]
-            word2ph.append(2)
+            phones, tones, n_phones = (initial, syllable[index:-1]), (tone, tone), 2
         else:
             medial = "i" if initial == "y" else "#"
             final_index = index
             if syllable[index] == "i":
-                final_index = next(it, index)
-                if final_index != index:
+                next_index = vowels.find("\x01", index + 1)
+                if next_index >= 0:
+                    final_index = next_index
                     medial = "i"
-            final = syllable[final_index:-1]
-            phones += [initial, medial, final]
-            tones += [tone, 0 if medial == "#" else tone, tone]
-            word2ph.append(3)
-
-    phones.append(pad)
-    tones.append(0)
-    word2ph.append(1)
+            phones = (initial, medial, syllable[final_index:-1])
+            tones = (tone, 0 if medial == "#" else tone, tone)
+            n_phones = 3
     symbol_to_id = waitau_symbol_to_id if language == "waitau" else hakka_symbol_to_id
     try:
-        phones = [symbol_to_id[symbol] for symbol in phones]
+        return tuple(symbol_to_id[symbol] for symbol in phones), tones, n_phones
     except KeyError as err:
         raise SymbolError() from err
-    lang_ids = [0] * len(phones)
 
-    phones = intersperse(phones, 0)
-    tones = intersperse(tones, 0)
-    lang_ids = intersperse(lang_ids, 0)
-    word2ph = [n * 2 for n in word2ph]
-    word2ph[0] += 1
+def generate_audio(language, voice, text, speed):
+    global models
+
+    name = f"{language}_{voice}"
+    if name not in models:
+        net = load_model(f"data/{name}.pth", "data/config.json", len(waitau_symbols if language == "waitau" else hakka_symbols))
+        counterpart = models.get(f"{language}_{'female' if voice == 'male' else 'male'}")
+        if counterpart is not None:
+            net = share_identical_tensors(net, counterpart)
+        models[name] = net
+
+    phones, tones, word2ph = [_PAD_ID], [0], [1]
+    for syllable in text.split():
+        key = (language, syllable)
+        entry = _syllable_cache.get(key)
+        if entry is None:
+            entry = _parse_syllable(language, syllable)
+            _syllable_cache[key] = entry
+        syllable_phones, syllable_tones, n_phones = entry
+        phones += syllable_phones
+        tones += syllable_tones
+        word2ph.append(n_phones)
+
+    phones.append(_PAD_ID)
+    tones.append(0)
+    word2ph.append(1)
     del word2ph
 
-    phones = torch.LongTensor(phones)
-    tones = torch.LongTensor(tones)
-    lang_ids = torch.LongTensor(lang_ids)
-    with torch.no_grad():
-        x_tst = phones.to(device).unsqueeze(0)
-        tones = tones.to(device).unsqueeze(0)
-        lang_ids = lang_ids.to(device).unsqueeze(0)
-        x_tst_lengths = torch.LongTensor([phones.size(0)]).to(device)
-        del phones
-        speakers = torch.LongTensor([0]).to(device)
-        audio = (
-            models[name].infer(
-                x_tst,
-                x_tst_lengths,
-                speakers,
-                tones,
-                lang_ids,
-                speed=speed,
-            )[0][0, 0]
-            .data.cpu()
-            .float()
-            .numpy()
-        )
-        del (
-            x_tst,
-            tones,
-            lang_ids,
-            x_tst_lengths,
-            speakers,
-        )
-        gc.collect()
-    return audio
+    # Intersperse phones and tones with zeros into one shared buffer: a
+    # single allocation and pass instead of one per sequence. The rows of
+    # the torch view alias the same memory, so no further copies are made.
+    # (The interspersed language ids are all zero; the scheduler builds them.)
+    stacked = np.zeros((2, 2 * len(phones) + 1), dtype=np.int64)
+    stacked[0, 1::2] = phones
+    stacked[1, 1::2] = tones
+    stacked = torch.from_numpy(stacked)
+    return _scheduler.submit(name, stacked[0], stacked[1], speed)
+
+_warmup()
@@ -2,8 +2,19 @@ import os
 import json
 import torch
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 from models import SynthesizerTrn
 
+# Prefer the oneDNN int8 engine (AVX-VNNI where available), else fbgemm.
+for _engine in ("onednn", "fbgemm"):
+    if _engine in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = _engine
+        break
+
 
 def load_checkpoint(checkpoint_path, model, optimizer=None, skip_optimizer=False):
     assert os.path.isfile(checkpoint_path)
@@ -54,7 +65,7 @@ def get_hparams_from_file(config_path):
     # print("config_path: ", config_path)
     with open(config_path, "r", encoding="utf-8") as f:
         data = f.read()
-    config = json.loads(data)
+    config = _json_loads(data)
 
     hparams = HParams(**config)
     return hparams
@@ -92,6 +103,33 @@ class HParams:
         return self.__dict__.__repr__()
 
 
+def share_identical_tensors(net, reference):
+    """Alias net's tensors to reference's storage where bitwise identical.
+
+    Checkpoints fine-tuned from a common base leave many weights unchanged;
+    retargeting those at the already-loaded copy means the pair of models
+    only keeps one resident copy of every shared tensor. Tensors that truly
+    differ (speaker embeddings, tuned layers) are left alone.
+    """
+    ref_state = reference.state_dict()
+    # state_dict() on net would return detached views, and retargeting those
+    # leaves the live parameters untouched; the assignment must happen on the
+    # module's own parameters and buffers. The reference's state_dict views
+    # do share storage with its live tensors, so they are valid alias targets.
+    for name, tensor in list(net.named_parameters()) + list(net.named_buffers()):
+        other = ref_state.get(name)
+        if other is None:
+            continue
+        try:
+            identical = torch.equal(tensor.data, other)
+        except Exception:
+            continue  # packed/quantized entries that cannot be compared
+        if identical:
+            tensor.data = other
+            assert tensor.data_ptr() == other.data_ptr()
+    return net
+
+
 def load_model(model_path, config_path, n_vocab):
     hps = get_hparams_from_file(config_path)
     net = SynthesizerTrn(
@@ -103,5 +141,12 @@ def load_model(model_path, config_path, n_vocab):
     ).to("cpu")
     _ = net.eval()
     _ = load_checkpoint(model_path, net, None, skip_optimizer=True)
+    # inplace: the default deepcopy path fails on weight_norm's non-leaf tensors
+    net = torch.ao.quantization.quantize_dynamic(net, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    try:
+        # dynamic=True because the input length varies per request
+        net.infer = torch.compile(net.infer, dynamic=True)
+    except Exception:
+        pass  # torch.compile unavailable on this build; keep eager infer
     return net
 